@@ -2,7 +2,11 @@ import streamlit as st
 import boto3
 from botocore.exceptions import ClientError
 import json
-from bedrock_utils import query_knowledge_base, generate_response, valid_prompt
+import os
+from bedrock_utils import token_usage, warm_up
+from rag_client import get_rag_client
+from rag_pipeline import answer_question, speculative_stats
+from shared_cache import cache_stats
 
 
 # Streamlit UI
@@ -10,12 +14,44 @@ st.title("Bedrock Chat Application")
 
 # Sidebar for configurations
 st.sidebar.header("Configuration")
-model_id = st.sidebar.selectbox("Select LLM Model", ["anthropic.claude-3-haiku-20240307-v1:0", "anthropic.claude-3-5-sonnet-20240620-v1:0"])
+model_id = st.sidebar.selectbox("Select LLM Model", ["anthropic.claude-3-haiku-20240307-v1:0", "anthropic.claude-3-5-sonnet-20240620-v1:0", "us.anthropic.claude-3-5-haiku-20241022-v1:0"])
 kb_id = st.sidebar.text_input("Knowledge Base ID", "DU9AYF1KM2")
 temperature = st.sidebar.select_slider("Temperature", [i/10 for i in range(0,11)],1)
 top_p = st.sidebar.select_slider("Top_P", [i/1000 for i in range(0,1001)], 1)
+speculative = st.sidebar.checkbox("Speculative Generation", value=False,
+                                  help="Start answering while the prompt is still being validated. Faster, but may spend tokens on rejected prompts.")
 debug_mode = st.sidebar.checkbox("Debug Mode", value=False)
 
+# Warm up clients and connections once per process, not inside the first request.
+# Configured from the environment only, so sidebar edits never trigger another warm-up.
+@st.cache_resource(show_spinner="Warming up AWS connections...")
+def warm_up_once():
+    return warm_up(
+        model_id=os.environ.get("WARMUP_MODEL_ID", "anthropic.claude-3-haiku-20240307-v1:0"),
+        kb_id=os.environ.get("KB_ID"),
+        keep_alive=os.environ.get("WARMUP_KEEP_ALIVE", "").lower() in ("1", "true", "yes"),
+        cluster_arn=os.environ.get("AURORA_CLUSTER_ARN"),
+        secret_arn=os.environ.get("AURORA_SECRET_ARN"),
+        database=os.environ.get("AURORA_DATABASE")
+    )
+
+# With RAG_SERVICE_URL set, the pipeline runs in rag_service.py and this app is a thin client
+rag_client = get_rag_client()
+if rag_client is None:
+    boot_timings = warm_up_once()
+    if debug_mode:
+        st.sidebar.write("🔍 Debug: Boot-time breakdown (ms)")
+        st.sidebar.json(boot_timings)
+        st.sidebar.write("🔍 Debug: Shared cache hit rates")
+        st.sidebar.json(cache_stats())
+        st.sidebar.write("🔍 Debug: Token usage (incl. prompt cache reads/writes)")
+        st.sidebar.json(token_usage())
+        if speculative:
+            st.sidebar.write("🔍 Debug: Speculative generation")
+            st.sidebar.json(speculative_stats())
+elif debug_mode:
+    st.sidebar.write(f"🔍 Debug: Using RAG service at {rag_client.base_url}")
+
 # Initialize chat history
 if "messages" not in st.session_state:
     st.session_state.messages = []
@@ -32,41 +68,16 @@ if prompt := st.chat_input("What would you like to know?"):
         st.markdown(prompt)
 
     try:
-        validation_result = valid_prompt(prompt, model_id)
+        if rag_client is not None:
+            result = rag_client.answer_question(prompt, model_id, kb_id, temperature, top_p, speculative)
+        else:
+            result = answer_question(prompt, model_id, kb_id, temperature, top_p, speculative)
+        response = result['answer']
         if debug_mode:
-            st.sidebar.write(f"🔍 Debug: Validation result = {validation_result}")
-        
-        if validation_result:
-            # Check if Knowledge Base ID is configured
-            if kb_id == "your-knowledge-base-id" or not kb_id:
-                response = "⚠️ Please configure your Knowledge Base ID in the sidebar."
+            st.sidebar.write(f"🔍 Debug: Validation result = {result['valid']}")
+            if result['valid']:
+                st.sidebar.write(f"🔍 Debug: Found {result['kb_results']} KB results")
             else:
-                # Query Knowledge Base
-                kb_results = query_knowledge_base(prompt, kb_id)
-                if debug_mode:
-                    st.sidebar.write(f"🔍 Debug: Found {len(kb_results)} KB results")
-                
-                # Prepare context from Knowledge Base results
-                if kb_results:
-                    context = "\n".join([
-                        result.get('content', {}).get('text', '') 
-                        for result in kb_results 
-                        if result.get('content', {}).get('text')
-                    ])
-                    
-                    if context:
-                        # Generate response using LLM with context
-                        full_prompt = f"Context: {context}\n\nUser: {prompt}\n\nAssistant:"
-                        response = generate_response(full_prompt, model_id, temperature, top_p)
-                        if not response:
-                            response = "⚠️ Error generating response. Please check your AWS credentials and model configuration."
-                    else:
-                        response = "I couldn't find relevant information in the knowledge base. Please try rephrasing your question."
-                else:
-                    response = "I couldn't find relevant information in the knowledge base. Please try rephrasing your question."
-        else:
-            response = "I'm unable to answer this question. Please ask about heavy machinery specifications, features, or related topics."
-            if debug_mode:
                 st.sidebar.warning("🔍 Debug: Prompt validation failed. Check terminal for category classification.")
     except Exception as e:
         error_msg = str(e)
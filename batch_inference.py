@@ -0,0 +1,479 @@
+"""
+Bulk Q&A generation with Bedrock Batch Inference.
+
+Packages questions (with Knowledge Base context) into a JSONL file, uploads it
+to S3, runs it as a Bedrock model invocation job, and streams the results into
+the answer cache and a SQLite results table.
+
+Every stage is checkpointed in the run's work directory, so re-running the
+same command after a crash picks up where it stopped:
+    prepare  -> prepared.jsonl built locally (resumes per question)
+    upload   -> records.jsonl written from it and uploaded to S3
+    submit   -> batch job created under a fixed job name saved beforehand; a
+                resumed run looks the name up instead of resubmitting
+    poll     -> waits for the job to finish
+    ingest   -> results stored (resumes per record)
+
+Usage:
+    python batch_inference.py questions.txt --run-id faq-2024-06 \\
+        --bucket bedrock-kb-401040007987 --role-arn arn:aws:iam::...:role/bedrock-batch
+
+    # On-demand calls instead of a batch job, against a local S3 stand-in (e.g. MinIO)
+    python batch_inference.py questions.txt --run-id test --bucket test-bucket \\
+        --s3-endpoint-url http://localhost:9000 --local-runner
+
+    # Fully offline: also fakes the Knowledge Base and the model
+    python batch_inference.py questions.txt --run-id test --bucket test-bucket \\
+        --s3-endpoint-url http://localhost:9000 --offline
+
+Questions with no Knowledge Base context are not sent to the model; they are
+recorded as errors in batch_results.
+
+Note: Bedrock batch jobs require a minimum number of records (100 at the
+time of writing); smaller runs are better served by --local-runner.
+"""
+import argparse
+import hashlib
+import io
+import json
+import os
+import sqlite3
+import time
+
+from botocore.exceptions import ClientError
+
+from bedrock_utils import get_bedrock_client, get_bedrock_kb_client, get_session
+from rag_pipeline import build_context, build_prompt
+from shared_cache import BATCH_ANSWER_TTL_SECONDS, store
+
+DEFAULT_MODEL_ID = "anthropic.claude-3-haiku-20240307-v1:0"
+DEFAULT_KB_ID = "DU9AYF1KM2"
+REGION = "us-east-1"
+
+# Job states reported by get_model_invocation_job
+DONE_STATES = {'Completed', 'PartiallyCompleted'}
+FAILED_STATES = {'Failed', 'Stopped', 'Expired'}
+
+NO_CONTEXT_ERROR = "No Knowledge Base context"
+
+class Checkpoint:
+    """Run state persisted as JSON, rewritten atomically after every change"""
+
+    def __init__(self, path):
+        self.path = path
+        if os.path.exists(path):
+            with open(path) as f:
+                self.state = json.load(f)
+        else:
+            self.state = {'stage': 'prepare'}
+
+    def __getitem__(self, key):
+        return self.state.get(key)
+
+    def update(self, **values):
+        self.state.update(values)
+        self.save()
+
+    def save(self):
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(self.state, f)
+        os.replace(tmp_path, self.path)
+
+class BedrockJobRunner:
+    """Runs model invocation jobs on Bedrock Batch Inference"""
+
+    def __init__(self, session, role_arn):
+        self.bedrock = session.client('bedrock', region_name=REGION)
+        self.role_arn = role_arn
+
+    def submit(self, job_name, model_id, input_uri, output_uri):
+        response = self.bedrock.create_model_invocation_job(
+            jobName=job_name,
+            roleArn=self.role_arn,
+            modelId=model_id,
+            inputDataConfig={'s3InputDataConfig': {'s3Uri': input_uri, 's3InputFormat': 'JSONL'}},
+            outputDataConfig={'s3OutputDataConfig': {'s3Uri': output_uri}}
+        )
+        return response['jobArn']
+
+    def find(self, job_name):
+        """Returns the ARN of the job named job_name, or None if it was never created"""
+        kwargs = {'nameContains': job_name}
+        while True:
+            response = self.bedrock.list_model_invocation_jobs(**kwargs)
+            for job in response.get('invocationJobSummaries', []):
+                if job['jobName'] == job_name:
+                    return job['jobArn']
+            if not response.get('nextToken'):
+                return None
+            kwargs['nextToken'] = response['nextToken']
+
+    def status(self, job_arn):
+        response = self.bedrock.get_model_invocation_job(jobIdentifier=job_arn)
+        return response['status'], response.get('message', '')
+
+class LocalJobRunner:
+    """
+    Stand-in for Bedrock Batch Inference that processes the input file with
+    on-demand invoke_model calls and writes output in the same format, so
+    the pipeline can be exercised offline (with a local S3 such as MinIO
+    and FakeBedrockRuntime). Jobs finish inside submit(), and resubmitting
+    a job name rewrites the same output object.
+    """
+
+    def __init__(self, s3, bedrock_runtime):
+        self.s3 = s3
+        self.bedrock_runtime = bedrock_runtime
+        self.jobs = {}
+
+    def submit(self, job_name, model_id, input_uri, output_uri):
+        bucket, input_key = split_s3_uri(input_uri)
+        _, output_prefix = split_s3_uri(output_uri)
+        body = self.s3.get_object(Bucket=bucket, Key=input_key)['Body']
+        lines = []
+        for line in body.iter_lines():
+            record = json.loads(line)
+            output = {'recordId': record['recordId'], 'modelInput': record['modelInput']}
+            try:
+                response = self.bedrock_runtime.invoke_model(
+                    modelId=model_id,
+                    contentType='application/json',
+                    accept='application/json',
+                    body=json.dumps(record['modelInput'])
+                )
+                output['modelOutput'] = json.loads(response['body'].read())
+            except ClientError as e:
+                output['error'] = {'errorMessage': str(e)}
+            lines.append(json.dumps(output))
+        job_id = hashlib.sha256(job_name.encode('utf-8')).hexdigest()[:12]
+        output_key = f"{output_prefix.rstrip('/')}/{job_id}/{os.path.basename(input_key)}.out"
+        self.s3.put_object(Bucket=bucket, Key=output_key, Body="\n".join(lines).encode('utf-8'))
+        job_arn = f"arn:local:bedrock:{REGION}:000000000000:model-invocation-job/{job_id}"
+        self.jobs[job_name] = job_arn
+        return job_arn
+
+    def find(self, job_name):
+        return self.jobs.get(job_name)
+
+    def status(self, job_arn):
+        # A resumed run has a fresh runner; its output is already in S3
+        return 'Completed', ''
+
+class FakeBedrockRuntime:
+    """bedrock-runtime stand-in for offline runs; answers every prompt with a canned reply"""
+
+    def __init__(self):
+        self.calls = 0
+
+    def invoke_model(self, modelId, body, **kwargs):
+        self.calls += 1
+        request = json.loads(body)
+        prompt = request['messages'][0]['content'][0]['text']
+        output = {
+            'content': [{'type': 'text', 'text': f"[offline answer from {modelId}]"}],
+            'stop_reason': 'end_turn',
+            'usage': {'input_tokens': len(prompt) // 4, 'output_tokens': 8},
+        }
+        return {'body': io.BytesIO(json.dumps(output).encode('utf-8'))}
+
+def kb_retrieve(query, kb_id, number_of_results=3):
+    """
+    Knowledge Base retrieval for prepare_records(). Unlike query_knowledge_base()
+    it raises on errors (e.g. throttling), so the run stops and a resume retries
+    the question instead of recording it as having no context.
+    """
+    response = get_bedrock_kb_client().retrieve(
+        knowledgeBaseId=kb_id,
+        retrievalQuery={'text': query},
+        retrievalConfiguration={'vectorSearchConfiguration': {'numberOfResults': number_of_results}}
+    )
+    return response.get('retrievalResults', [])
+
+def fake_retrieve(query, kb_id):
+    """kb_retrieve() stand-in for offline runs"""
+    return [{'content': {'text': f"[offline context for: {query}]"}, 'score': 1.0}]
+
+def split_s3_uri(uri):
+    """Splits s3://bucket/key into (bucket, key)"""
+    bucket, _, key = uri[len('s3://'):].partition('/')
+    return bucket, key
+
+def record_id(question):
+    """Stable record ID, so resumed runs and results match up across restarts"""
+    return hashlib.sha256(question.encode('utf-8')).hexdigest()[:16]
+
+def load_questions(path):
+    """Reads questions from a text file (one per line) or JSONL with a 'question' field"""
+    questions = []
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            if path.endswith('.jsonl'):
+                line = json.loads(line)['question']
+            questions.append(line)
+    # Duplicates would share a record ID
+    return list(dict.fromkeys(questions))
+
+def read_jsonl(path):
+    """Reads a JSONL file, skipping a line left half-written by a crash"""
+    rows = []
+    if not os.path.exists(path):
+        return rows
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            try:
+                rows.append(json.loads(line))
+            except ValueError:
+                break
+    return rows
+
+def prepare_records(questions, prepared_path, model_id, kb_id, temperature, top_p, max_tokens,
+                    retrieve=kb_retrieve):
+    """
+    Retrieves context for each question and writes one prepared record per
+    question to prepared_path. Questions already in the file are skipped.
+    Questions without context get an error row instead of a model input.
+    """
+    rows = read_jsonl(prepared_path)
+    prepared = {row['recordId'] for row in rows}
+    # Drop any half-written trailing line before appending
+    tmp_path = f"{prepared_path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        for row in rows:
+            f.write(json.dumps(row) + "\n")
+    os.replace(tmp_path, prepared_path)
+
+    with open(prepared_path, 'a', encoding='utf-8') as f:
+        for question in questions:
+            rid = record_id(question)
+            if rid in prepared:
+                continue
+            context = build_context(retrieve(question, kb_id))
+            if not context:
+                print(f"   [WARNING] No Knowledge Base context, skipping: {question[:60]}")
+                row = {'recordId': rid, 'question': question, 'error': NO_CONTEXT_ERROR}
+            else:
+                row = {
+                    'recordId': rid,
+                    'question': question,
+                    'modelInput': {
+                        "anthropic_version": "bedrock-2023-05-31",
+                        "messages": [{"role": "user", "content": [{"type": "text", "text": build_prompt(context, question)}]}],
+                        "max_tokens": max_tokens,
+                        "temperature": temperature,
+                        "top_p": top_p,
+                    }
+                }
+            f.write(json.dumps(row) + "\n")
+            f.flush()
+            prepared.add(rid)
+            if len(prepared) % 25 == 0:
+                print(f"   Prepared {len(prepared)}/{len(questions)} records")
+    return len(prepared)
+
+def write_batch_input(prepared_path, records_path):
+    """
+    Writes the batch input file, which may only hold recordId and modelInput.
+    Returns the number of records written.
+    """
+    count = 0
+    with open(records_path, 'w', encoding='utf-8') as f:
+        for row in read_jsonl(prepared_path):
+            if 'modelInput' not in row:
+                continue
+            f.write(json.dumps({'recordId': row['recordId'], 'modelInput': row['modelInput']}) + "\n")
+            count += 1
+    return count
+
+def wait_for_job(runner, job_arn, initial_interval=30, max_interval=300):
+    """Polls the job with exponential backoff until it finishes"""
+    interval = initial_interval
+    while True:
+        status, message = runner.status(job_arn)
+        print(f"Status: {status}")
+        if status in DONE_STATES:
+            return status
+        if status in FAILED_STATES:
+            raise Exception(f"Batch job {status}: {message}")
+        time.sleep(interval)
+        interval = min(interval * 2, max_interval)
+
+def open_results_db(path):
+    """Opens the SQLite results table"""
+    conn = sqlite3.connect(path)
+    conn.execute("""CREATE TABLE IF NOT EXISTS batch_results (
+        run_id TEXT NOT NULL,
+        record_id TEXT NOT NULL,
+        question TEXT,
+        answer TEXT,
+        error TEXT,
+        input_tokens INTEGER,
+        output_tokens INTEGER,
+        PRIMARY KEY (run_id, record_id)
+    )""")
+    return conn
+
+def ingest_results(s3, output_uri, prepared_path, results_db, run_id, model_id, temperature, top_p):
+    """
+    Streams job output from S3 into the answer cache and the results table,
+    along with the questions prepare_records() skipped. Records already in
+    the results table are skipped.
+    """
+    prepared = {row['recordId']: row for row in read_jsonl(prepared_path)}
+    ingested = {rid for (rid,) in results_db.execute(
+        "SELECT record_id FROM batch_results WHERE run_id = ?", (run_id,))}
+
+    for rid, row in prepared.items():
+        if 'error' in row and rid not in ingested:
+            results_db.execute(
+                "INSERT OR REPLACE INTO batch_results VALUES (?, ?, ?, NULL, ?, NULL, NULL)",
+                (run_id, rid, row['question'], row['error'])
+            )
+            ingested.add(rid)
+    results_db.commit()
+
+    bucket, prefix = split_s3_uri(output_uri)
+    paginator = s3.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for obj in page.get('Contents', []):
+            if not obj['Key'].endswith('.jsonl.out'):
+                continue
+            body = s3.get_object(Bucket=bucket, Key=obj['Key'])['Body']
+            for line in body.iter_lines():
+                output = json.loads(line)
+                rid = output['recordId']
+                if rid in ingested or 'modelInput' not in prepared.get(rid, {}):
+                    continue
+                answer, error, usage = None, None, {}
+                if 'modelOutput' in output:
+                    answer = output['modelOutput']['content'][0]['text']
+                    usage = output['modelOutput'].get('usage', {})
+                    # Same key generate_response() uses, so the chat app hits it
+                    prompt = prepared[rid]['modelInput']['messages'][0]['content'][0]['text']
+                    store('answer', [model_id, temperature, top_p, prompt], answer, ttl=BATCH_ANSWER_TTL_SECONDS)
+                else:
+                    error = output.get('error', {}).get('errorMessage', 'unknown error')
+                results_db.execute(
+                    "INSERT OR REPLACE INTO batch_results VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (run_id, rid, prepared[rid]['question'], answer, error,
+                     usage.get('input_tokens'), usage.get('output_tokens'))
+                )
+                results_db.commit()
+                ingested.add(rid)
+    return len(ingested)
+
+def run_batch(questions_path, run_id, bucket, runner, s3, work_dir, model_id, kb_id,
+              temperature=1.0, top_p=1.0, max_tokens=500, results_db_path='batch_results.sqlite3',
+              retrieve=kb_retrieve):
+    """Runs (or resumes) a batch from questions_path through every stage"""
+    os.makedirs(work_dir, exist_ok=True)
+    checkpoint = Checkpoint(os.path.join(work_dir, 'checkpoint.json'))
+    prepared_path = os.path.join(work_dir, 'prepared.jsonl')
+    records_path = os.path.join(work_dir, 'records.jsonl')
+    input_uri = f"s3://{bucket}/batch/{run_id}/input/records.jsonl"
+    output_uri = f"s3://{bucket}/batch/{run_id}/output/"
+
+    print("=" * 60)
+    print(f"Batch run: {run_id} (resuming from stage: {checkpoint['stage']})")
+    print("=" * 60)
+
+    if checkpoint['stage'] == 'prepare':
+        questions = load_questions(questions_path)
+        print(f"Preparing {len(questions)} records...")
+        prepare_records(questions, prepared_path, model_id, kb_id, temperature, top_p, max_tokens, retrieve)
+        checkpoint.update(stage='upload')
+
+    if checkpoint['stage'] == 'upload':
+        count = write_batch_input(prepared_path, records_path)
+        if count == 0:
+            print("No records with Knowledge Base context; nothing to submit")
+            checkpoint.update(stage='ingest')
+        else:
+            if count < 100:
+                print(f"   [WARNING] {count} records; Bedrock batch jobs require at least 100")
+            print(f"Uploading {count} records to {input_uri}")
+            input_bucket, input_key = split_s3_uri(input_uri)
+            s3.upload_file(records_path, input_bucket, input_key)
+            checkpoint.update(stage='submit')
+
+    if checkpoint['stage'] == 'submit':
+        # Saved before submitting: a crash after create_model_invocation_job
+        # leaves a job under this name, which the resumed run picks up
+        if not checkpoint['job_name']:
+            checkpoint.update(job_name=f"bulk-qa-{run_id}")
+        job_arn = runner.find(checkpoint['job_name'])
+        if job_arn:
+            print(f"Batch job already submitted: {job_arn}")
+        else:
+            job_arn = runner.submit(checkpoint['job_name'], model_id, input_uri, output_uri)
+            print(f"Batch job submitted: {job_arn}")
+        checkpoint.update(stage='poll', job_arn=job_arn)
+
+    if checkpoint['stage'] == 'poll':
+        status = wait_for_job(runner, checkpoint['job_arn'])
+        checkpoint.update(stage='ingest', job_status=status)
+
+    if checkpoint['stage'] == 'ingest':
+        results_db = open_results_db(results_db_path)
+        try:
+            count = ingest_results(s3, output_uri, prepared_path, results_db,
+                                   run_id, model_id, temperature, top_p)
+        finally:
+            results_db.close()
+        print(f"Ingested {count} results into {results_db_path} and the answer cache")
+        checkpoint.update(stage='done')
+
+    print("=" * 60)
+    print(f"Batch run {run_id}: {checkpoint['stage']}")
+    print("=" * 60)
+    return checkpoint.state
+
+def main():
+    parser = argparse.ArgumentParser(description="Bulk Q&A generation with Bedrock Batch Inference")
+    parser.add_argument('questions', help="Text file with one question per line, or JSONL with a 'question' field")
+    parser.add_argument('--run-id', required=True, help="Name of the run; re-use it to resume")
+    parser.add_argument('--bucket', required=True, help="S3 bucket for batch input and output")
+    parser.add_argument('--role-arn', help="IAM service role Bedrock assumes to read and write the bucket")
+    parser.add_argument('--model-id', default=DEFAULT_MODEL_ID)
+    parser.add_argument('--kb-id', default=DEFAULT_KB_ID)
+    # Defaults match the chat app's sliders; the answer cache key includes both
+    parser.add_argument('--temperature', type=float, default=1.0,
+                        help="Must match the chat app's setting for it to use the cached answers")
+    parser.add_argument('--top-p', type=float, default=1.0,
+                        help="Must match the chat app's setting for it to use the cached answers")
+    parser.add_argument('--work-dir', help="Checkpoint directory (default: .batch/<run-id>)")
+    parser.add_argument('--results-db', default='batch_results.sqlite3')
+    parser.add_argument('--s3-endpoint-url', help="Local S3 stand-in, e.g. http://localhost:9000")
+    parser.add_argument('--local-runner', action='store_true',
+                        help="Process the job with on-demand calls instead of Bedrock Batch Inference")
+    parser.add_argument('--offline', action='store_true',
+                        help="Use the local runner with a fake model and Knowledge Base (implies --local-runner)")
+    args = parser.parse_args()
+
+    retrieve = kb_retrieve
+    if args.offline:
+        # Keep fake answers out of the shared answer cache
+        os.environ['BEDROCK_CACHE_URL'] = 'none'
+        retrieve = fake_retrieve
+
+    session = get_session()
+    s3 = session.client('s3', region_name=REGION, endpoint_url=args.s3_endpoint_url)
+    if args.offline:
+        runner = LocalJobRunner(s3, FakeBedrockRuntime())
+    elif args.local_runner:
+        runner = LocalJobRunner(s3, get_bedrock_client())
+    elif args.role_arn:
+        runner = BedrockJobRunner(session, args.role_arn)
+    else:
+        parser.error("--role-arn is required unless --local-runner is used")
+
+    run_batch(args.questions, args.run_id, args.bucket, runner, s3,
+              args.work_dir or os.path.join('.batch', args.run_id),
+              args.model_id, args.kb_id, args.temperature, args.top_p,
+              results_db_path=args.results_db, retrieve=retrieve)
+
+if __name__ == "__main__":
+    main()
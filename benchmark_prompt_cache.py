@@ -0,0 +1,132 @@
+"""
+Before/after benchmark for Anthropic prompt caching on Bedrock.
+
+Runs the same classification and generation calls with cache_control off and
+on, and reports latency percentiles, token usage (including prompt cache reads
+and writes) and the relative input-token cost of each mode as JSON.
+
+Usage:
+    python benchmark_prompt_cache.py --model-id us.anthropic.claude-3-5-haiku-20241022-v1:0 \\
+        --kb-id DU9AYF1KM2 --runs 3 --output prompt_cache_benchmark.json
+
+Note: Bedrock only caches prefixes above a model-specific minimum length
+(1,024 tokens for Claude 3.5/3.7 Sonnet, 2,048 for Claude 3.5 Haiku).
+Shorter prefixes are sent uncached and show no cache reads.
+"""
+import argparse
+import json
+import math
+import os
+import time
+
+# Measure the model, not the shared result cache
+os.environ['BEDROCK_CACHE_URL'] = 'none'
+
+import bedrock_utils
+from bedrock_utils import generate_response, query_knowledge_base, token_usage, valid_prompt
+from rag_pipeline import build_context
+
+# Input-token price multipliers relative to uncached input tokens
+CACHE_WRITE_PRICE = 1.25
+CACHE_READ_PRICE = 0.1
+
+QUESTIONS = [
+    "What is the engine power of the X950 excavator?",
+    "What is the maximum lifting capacity of the MC750 mobile crane?",
+    "How much can the FL250 forklift lift?",
+    "What is the payload capacity of the DT1000 dump truck?",
+    "What is the operating weight of the BD850 bulldozer?",
+]
+
+def percentile(values, pct):
+    """Nearest-rank percentile of a list of numbers"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, math.ceil(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+def usage_delta(before, after):
+    """Token usage added between two token_usage() snapshots"""
+    delta = {}
+    for kind, totals in after.items():
+        previous = before.get(kind, {})
+        delta[kind] = {field: value - previous.get(field, 0) for field, value in totals.items()}
+    return delta
+
+def relative_input_cost(usage):
+    """Input cost in units of one uncached input token"""
+    return round(usage.get('input_tokens', 0)
+                 + usage.get('cache_creation_input_tokens', 0) * CACHE_WRITE_PRICE
+                 + usage.get('cache_read_input_tokens', 0) * CACHE_READ_PRICE, 1)
+
+def run_mode(enabled, model_id, contexts, runs):
+    """Runs every question `runs` times with prompt caching on or off"""
+    bedrock_utils.PROMPT_CACHE_ENABLED = enabled
+    latencies = {'classify': [], 'generate': []}
+    before = token_usage()
+    for _ in range(runs):
+        for question in QUESTIONS:
+            start = time.perf_counter()
+            valid_prompt(question, model_id)
+            latencies['classify'].append((time.perf_counter() - start) * 1000)
+            if contexts.get(question):
+                start = time.perf_counter()
+                generate_response(question, model_id, 0, 1, context=contexts[question])
+                latencies['generate'].append((time.perf_counter() - start) * 1000)
+    usage = usage_delta(before, token_usage())
+
+    report = {}
+    for kind, values in latencies.items():
+        kind_usage = usage.get(kind, {})
+        report[kind] = {
+            'calls': len(values),
+            'latency_ms': {
+                'p50': round(percentile(values, 50), 1),
+                'p95': round(percentile(values, 95), 1),
+                'mean': round(sum(values) / len(values), 1) if values else 0.0,
+            },
+            'usage': kind_usage,
+            'relative_input_cost': relative_input_cost(kind_usage),
+        }
+    return report
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark Bedrock prompt caching")
+    parser.add_argument('--model-id', default="us.anthropic.claude-3-5-haiku-20241022-v1:0")
+    parser.add_argument('--kb-id', default="DU9AYF1KM2")
+    parser.add_argument('--runs', type=int, default=3, help="Passes over the question set per mode")
+    parser.add_argument('--output', help="Also write the JSON report to this file")
+    args = parser.parse_args()
+
+    if not bedrock_utils.supports_prompt_cache(args.model_id):
+        print(f"[WARNING] {args.model_id} is not in PROMPT_CACHE_MODELS; both modes will run uncached")
+
+    # Retrieve once so both modes send identical context
+    contexts = {question: build_context(query_knowledge_base(question, args.kb_id)) for question in QUESTIONS}
+
+    report = {
+        'model_id': args.model_id,
+        'runs': args.runs,
+        'questions': len(QUESTIONS),
+        'uncached': run_mode(False, args.model_id, contexts, args.runs),
+        'cached': run_mode(True, args.model_id, contexts, args.runs),
+    }
+    for kind in ('classify', 'generate'):
+        before = report['uncached'][kind]
+        after = report['cached'][kind]
+        report[f'{kind}_p50_latency_change_pct'] = round(
+            (after['latency_ms']['p50'] - before['latency_ms']['p50']) / before['latency_ms']['p50'] * 100, 1
+        ) if before['latency_ms']['p50'] else 0.0
+        report[f'{kind}_input_cost_change_pct'] = round(
+            (after['relative_input_cost'] - before['relative_input_cost']) / before['relative_input_cost'] * 100, 1
+        ) if before['relative_input_cost'] else 0.0
+
+    output = json.dumps(report, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+
+if __name__ == "__main__":
+    main()
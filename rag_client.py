@@ -0,0 +1,71 @@
+"""
+Client for the headless RAG service (rag_service.py). Mirrors the
+rag_pipeline functions so app.py can switch between in-process and remote
+inference with RAG_SERVICE_URL.
+"""
+import codecs
+import json
+import os
+import urllib.error
+import urllib.request
+
+DEFAULT_TIMEOUT = 60
+
+class RAGClient:
+    """Thin HTTP client for the RAG service"""
+
+    def __init__(self, base_url, timeout=DEFAULT_TIMEOUT):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+
+    def _post(self, path, payload):
+        request = urllib.request.Request(
+            f"{self.base_url}{path}",
+            data=json.dumps(payload).encode('utf-8'),
+            headers={'Content-Type': 'application/json'},
+            method='POST'
+        )
+        try:
+            return urllib.request.urlopen(request, timeout=self.timeout)
+        except urllib.error.HTTPError as e:
+            try:
+                message = json.loads(e.read()).get('error', str(e))
+            except ValueError:
+                message = str(e)
+            raise Exception(f"RAG service error ({e.code}): {message}")
+
+    def valid_prompt(self, prompt, model_id):
+        with self._post('/validate', {'prompt': prompt, 'model_id': model_id}) as response:
+            return json.loads(response.read())['valid']
+
+    def query_knowledge_base(self, query, kb_id):
+        with self._post('/retrieve', {'query': query, 'kb_id': kb_id}) as response:
+            return json.loads(response.read())['results']
+
+    def answer_question(self, prompt, model_id, kb_id, temperature, top_p, speculative=False):
+        payload = {'prompt': prompt, 'model_id': model_id, 'kb_id': kb_id,
+                   'temperature': temperature, 'top_p': top_p, 'speculative': speculative}
+        with self._post('/answer', payload) as response:
+            return json.loads(response.read())
+
+    def stream_answer(self, prompt, model_id, kb_id, temperature, top_p):
+        payload = {'prompt': prompt, 'model_id': model_id, 'kb_id': kb_id,
+                   'temperature': temperature, 'top_p': top_p}
+        # Characters such as "⚠️" and "³" can be split across reads
+        decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        with self._post('/answer/stream', payload) as response:
+            while True:
+                chunk = response.read1(1024)
+                if not chunk:
+                    break
+                text = decoder.decode(chunk)
+                if text:
+                    yield text
+            text = decoder.decode(b'', final=True)
+            if text:
+                yield text
+
+def get_rag_client():
+    """Returns a client for RAG_SERVICE_URL, or None to run the pipeline in-process"""
+    url = os.environ.get('RAG_SERVICE_URL')
+    return RAGClient(url) if url else None
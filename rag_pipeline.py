@@ -0,0 +1,188 @@
+"""
+Validate -> retrieve -> generate pipeline shared by the Streamlit app and the
+headless RAG service (rag_service.py)
+"""
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from bedrock_utils import build_prompt, query_knowledge_base, generate_response, generate_response_stream, valid_prompt
+from shared_cache import store
+
+# Speculative mode starts generating only when the best KB chunk scores at least this
+SPECULATIVE_MIN_SCORE = float(os.environ.get('SPECULATIVE_MIN_SCORE', 0.6))
+# Cost guard: most tokens a speculative generation may produce before validation
+SPECULATIVE_MAX_TOKENS = int(os.environ.get('SPECULATIVE_MAX_TOKENS', 500))
+ANSWER_MAX_TOKENS = 500
+
+_executor = ThreadPoolExecutor(max_workers=int(os.environ.get('SPECULATIVE_WORKERS', 16)))
+_speculative_lock = threading.Lock()
+_speculative_metrics = {
+    'started': 0,            # speculative generations launched
+    'released': 0,           # buffered answers returned to the user
+    'discarded': 0,          # thrown away because validation rejected the prompt
+    'truncated': 0,          # hit SPECULATIVE_MAX_TOKENS and had to be regenerated
+    'skipped_low_score': 0,  # retrieval score too low to speculate
+    'wasted_output_tokens': 0,
+    'saved_ms': 0.0,         # generation time overlapped with validation
+}
+
+KB_NOT_CONFIGURED_MESSAGE = "⚠️ Please configure your Knowledge Base ID in the sidebar."
+NO_CONTEXT_MESSAGE = "I couldn't find relevant information in the knowledge base. Please try rephrasing your question."
+GENERATION_ERROR_MESSAGE = "⚠️ Error generating response. Please check your AWS credentials and model configuration."
+REJECTED_MESSAGE = "I'm unable to answer this question. Please ask about heavy machinery specifications, features, or related topics."
+
+def build_context(kb_results):
+    """Joins the text of the Knowledge Base results into a single context block"""
+    return "\n".join([
+        result.get('content', {}).get('text', '')
+        for result in kb_results
+        if result.get('content', {}).get('text')
+    ])
+
+def _prepare(prompt, model_id, kb_id):
+    """
+    Runs validation and retrieval. Returns (result, context) where context
+    is None when the pipeline ends early with result['answer'].
+    """
+    result = {'valid': valid_prompt(prompt, model_id), 'kb_results': 0, 'answer': None}
+    if not result['valid']:
+        result['answer'] = REJECTED_MESSAGE
+        return result, None
+    # Check if Knowledge Base ID is configured
+    if kb_id == "your-knowledge-base-id" or not kb_id:
+        result['answer'] = KB_NOT_CONFIGURED_MESSAGE
+        return result, None
+
+    kb_results = query_knowledge_base(prompt, kb_id)
+    result['kb_results'] = len(kb_results)
+    context = build_context(kb_results)
+    if not context:
+        result['answer'] = NO_CONTEXT_MESSAGE
+        return result, None
+    return result, context
+
+def answer_question(prompt, model_id, kb_id, temperature, top_p, speculative=False):
+    """
+    Answers a user question end to end.
+    Args:
+        speculative: Start generating while validation is still running
+            (see _answer_speculatively)
+    Returns:
+        Dict with 'answer', 'valid' (validation result) and 'kb_results'
+        (number of Knowledge Base results used as context)
+    """
+    if speculative and kb_id and kb_id != "your-knowledge-base-id":
+        return _answer_speculatively(prompt, model_id, kb_id, temperature, top_p)
+    result, context = _prepare(prompt, model_id, kb_id)
+    if context is not None:
+        result['answer'] = generate_response(prompt, model_id, temperature, top_p, context=context) or GENERATION_ERROR_MESSAGE
+    return result
+
+def stream_answer(prompt, model_id, kb_id, temperature, top_p):
+    """
+    Same as answer_question() but yields the answer text in chunks as it is
+    generated. Early exits (rejected prompt, no context) yield one message.
+    """
+    result, context = _prepare(prompt, model_id, kb_id)
+    if context is None:
+        yield result['answer']
+        return
+    streamed = False
+    for chunk in generate_response_stream(prompt, model_id, temperature, top_p, context=context):
+        streamed = True
+        yield chunk
+    if not streamed:
+        yield GENERATION_ERROR_MESSAGE
+
+def _count(metric, amount=1):
+    with _speculative_lock:
+        _speculative_metrics[metric] += amount
+
+def speculative_stats():
+    """Returns a snapshot of the speculative generation counters"""
+    with _speculative_lock:
+        return dict(_speculative_metrics)
+
+def _buffer_generation(prompt, context, model_id, temperature, top_p, cancel, stats):
+    """Generates into a buffer, stopping as soon as cancel is set"""
+    chunks = []
+    for chunk in generate_response_stream(prompt, model_id, temperature, top_p, context=context,
+                                          max_tokens=min(SPECULATIVE_MAX_TOKENS, ANSWER_MAX_TOKENS),
+                                          store_result=False, stats=stats):
+        if cancel.is_set():
+            break
+        chunks.append(chunk)
+    text = "".join(chunks)
+    # Usage only arrives with the final event, so estimate it for cancelled streams
+    stats.setdefault('output_tokens', len(text) // 4)
+    return text
+
+def _record_waste(future):
+    stats = getattr(future, 'stats', {})
+    _count('wasted_output_tokens', stats.get('output_tokens', 0))
+
+def _answer_speculatively(prompt, model_id, kb_id, temperature, top_p):
+    """
+    Runs validation and retrieval in parallel and, when retrieval looks like
+    a confident heavy-machinery match, starts generating into a buffer before
+    validation finishes. The buffer is returned only if validation passes and
+    is discarded otherwise, so nothing generated for a rejected prompt is
+    ever shown or cached.
+    """
+    validation = _executor.submit(valid_prompt, prompt, model_id)
+    kb_results = query_knowledge_base(prompt, kb_id)
+    context = build_context(kb_results)
+    top_score = max((r.get('score', 0) for r in kb_results), default=0)
+
+    speculation = None
+    cancel = threading.Event()
+    if context and not validation.done():
+        if top_score >= SPECULATIVE_MIN_SCORE:
+            stats = {}
+            speculation = _executor.submit(_buffer_generation, prompt, context, model_id,
+                                           temperature, top_p, cancel, stats)
+            speculation.stats = stats
+            started_at = time.perf_counter()
+            _count('started')
+        else:
+            _count('skipped_low_score')
+
+    try:
+        valid = validation.result()
+    except Exception:
+        cancel.set()
+        if speculation is not None:
+            _count('discarded')
+            speculation.add_done_callback(_record_waste)
+        raise
+
+    result = {'valid': valid, 'kb_results': len(kb_results), 'answer': None}
+    if not valid:
+        result['answer'] = REJECTED_MESSAGE
+        if speculation is not None:
+            cancel.set()
+            _count('discarded')
+            speculation.add_done_callback(_record_waste)
+        return result
+    if not context:
+        result['answer'] = NO_CONTEXT_MESSAGE
+        return result
+
+    if speculation is not None:
+        _count('saved_ms', round((time.perf_counter() - started_at) * 1000, 1))
+        answer = speculation.result()
+        truncated = (speculation.stats.get('stop_reason') == 'max_tokens'
+                     and SPECULATIVE_MAX_TOKENS < ANSWER_MAX_TOKENS)
+        if answer and not truncated:
+            _count('released')
+            store('answer', [model_id, temperature, top_p, build_prompt(context, prompt)], answer)
+            result['answer'] = answer
+            return result
+        if truncated:
+            _count('truncated')
+            _count('wasted_output_tokens', speculation.stats.get('output_tokens', 0))
+
+    result['answer'] = generate_response(prompt, model_id, temperature, top_p, context=context) or GENERATION_ERROR_MESSAGE
+    return result
@@ -0,0 +1,205 @@
+"""
+Headless RAG service exposing the chat pipeline over HTTP, so the inference
+tier can be scaled separately from the Streamlit UI.
+
+Run with:
+    uvicorn rag_service:app --host 0.0.0.0 --port 8000 --workers 4
+
+Endpoints (all POST with a JSON body, except /health):
+    /validate       {prompt, model_id}                              -> {valid}
+    /retrieve       {query, kb_id}                                  -> {results}
+    /answer         {prompt, model_id, kb_id, temperature, top_p,
+                     speculative (optional)}                       -> {answer, valid, kb_results}
+    /answer/stream  same body as /answer                            -> text/plain chunks
+    /health                                                         -> {status, in_flight, waiting}
+    /metrics                                                        -> {speculative, cache, tokens}
+
+Configuration (environment variables):
+    RAG_MAX_CONCURRENCY  requests handled at once per worker (default 8)
+    RAG_MAX_QUEUE        requests allowed to wait for a slot before 503 (default 32)
+    RAG_QUEUE_TIMEOUT    seconds a request may wait for a slot before 503 (default 30)
+"""
+import asyncio
+import contextlib
+import os
+
+from starlette.applications import Starlette
+from starlette.concurrency import iterate_in_threadpool, run_in_threadpool
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Route
+
+from bedrock_utils import query_knowledge_base, token_usage, valid_prompt, warm_up
+from rag_pipeline import answer_question, speculative_stats, stream_answer
+from shared_cache import cache_stats
+
+MAX_CONCURRENCY = int(os.environ.get('RAG_MAX_CONCURRENCY', 8))
+MAX_QUEUE = int(os.environ.get('RAG_MAX_QUEUE', 32))
+QUEUE_TIMEOUT = float(os.environ.get('RAG_QUEUE_TIMEOUT', 30))
+
+class QueueFull(Exception):
+    """Raised when a request can't get a processing slot"""
+
+class RequestLimiter:
+    """Caps in-flight requests and the number of requests waiting for a slot"""
+
+    def __init__(self, max_concurrency, max_queue, timeout):
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.in_flight = 0
+        self.waiting = 0
+
+    async def acquire(self):
+        if self._semaphore.locked() and self.waiting >= self.max_queue:
+            raise QueueFull("Request queue is full")
+        self.waiting += 1
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), self.timeout)
+        except asyncio.TimeoutError:
+            raise QueueFull(f"Timed out after {self.timeout}s waiting for a free slot")
+        finally:
+            self.waiting -= 1
+        self.in_flight += 1
+
+    def release(self):
+        self.in_flight -= 1
+        self._semaphore.release()
+
+limiter = RequestLimiter(MAX_CONCURRENCY, MAX_QUEUE, QUEUE_TIMEOUT)
+
+def _error(status_code, message):
+    return JSONResponse({'error': message}, status_code=status_code)
+
+async def _read_body(request, *required):
+    """Parses the JSON body and checks required fields, returning (body, error_response)"""
+    try:
+        body = await request.json()
+    except ValueError:
+        return None, _error(400, "Request body must be JSON")
+    if not isinstance(body, dict):
+        return None, _error(400, "Request body must be a JSON object")
+    missing = [field for field in required if field not in body]
+    if missing:
+        return None, _error(400, f"Missing fields: {', '.join(missing)}")
+    return body, None
+
+async def _run_limited(func, *args):
+    """Runs a blocking pipeline call in the threadpool under the concurrency limit"""
+    try:
+        await limiter.acquire()
+    except QueueFull as e:
+        return None, _error(503, str(e))
+    try:
+        return await run_in_threadpool(func, *args), None
+    except Exception as e:
+        # Credentials errors from valid_prompt() end up here
+        return None, _error(500, str(e))
+    finally:
+        limiter.release()
+
+class LimitedStreamingResponse(StreamingResponse):
+    """
+    Streaming response that releases its limiter slot even when the body is
+    never iterated (e.g. the client disconnects before streaming starts)
+    """
+
+    def __init__(self, content, release, **kwargs):
+        super().__init__(content, **kwargs)
+        self._release = release
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            self._release()
+
+async def validate(request):
+    body, error = await _read_body(request, 'prompt', 'model_id')
+    if error:
+        return error
+    valid, error = await _run_limited(valid_prompt, body['prompt'], body['model_id'])
+    return error or JSONResponse({'valid': valid})
+
+async def retrieve(request):
+    body, error = await _read_body(request, 'query', 'kb_id')
+    if error:
+        return error
+    results, error = await _run_limited(query_knowledge_base, body['query'], body['kb_id'])
+    return error or JSONResponse({'results': results})
+
+ANSWER_FIELDS = ('prompt', 'model_id', 'kb_id', 'temperature', 'top_p')
+
+async def answer(request):
+    body, error = await _read_body(request, *ANSWER_FIELDS)
+    if error:
+        return error
+    args = [body[field] for field in ANSWER_FIELDS] + [bool(body.get('speculative', False))]
+    result, error = await _run_limited(answer_question, *args)
+    return error or JSONResponse(result)
+
+async def answer_stream(request):
+    body, error = await _read_body(request, *ANSWER_FIELDS)
+    if error:
+        return error
+    try:
+        await limiter.acquire()
+    except QueueFull as e:
+        return _error(503, str(e))
+
+    # The slot is held until the last chunk has been sent
+    released = False
+
+    def release_once():
+        nonlocal released
+        if not released:
+            released = True
+            limiter.release()
+
+    async def chunks():
+        try:
+            async for chunk in iterate_in_threadpool(stream_answer(*[body[field] for field in ANSWER_FIELDS])):
+                yield chunk
+        except Exception as e:
+            yield f"⚠️ Error: {e}"
+        finally:
+            release_once()
+
+    try:
+        return LimitedStreamingResponse(chunks(), release_once, media_type='text/plain; charset=utf-8')
+    except Exception:
+        release_once()
+        raise
+
+async def health(request):
+    return JSONResponse({
+        'status': 'ok',
+        'in_flight': limiter.in_flight,
+        'waiting': limiter.waiting,
+        'max_concurrency': limiter.max_concurrency,
+    })
+
+async def metrics(request):
+    return JSONResponse({
+        'speculative': speculative_stats(),
+        'cache': await run_in_threadpool(cache_stats),
+        'tokens': token_usage(),
+    })
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    # Open clients and connections before the first request arrives
+    await run_in_threadpool(warm_up, None, os.environ.get('KB_ID'))
+    yield
+
+app = Starlette(
+    routes=[
+        Route('/validate', validate, methods=['POST']),
+        Route('/retrieve', retrieve, methods=['POST']),
+        Route('/answer', answer, methods=['POST']),
+        Route('/answer/stream', answer_stream, methods=['POST']),
+        Route('/health', health, methods=['GET']),
+        Route('/metrics', metrics, methods=['GET']),
+    ],
+    lifespan=lifespan,
+)
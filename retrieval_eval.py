@@ -0,0 +1,452 @@
+"""
+Retrieval quality and latency regression suite over the spec-sheet corpus.
+
+Runs every question in a gold set (eval/gold_set.json) against one or more
+retrieval backends and reports, per backend and per k:
+    recall@k          share of expected spec sheets found in the top k
+    MRR@k             mean reciprocal rank of the first relevant result
+    input_tokens_est  tokens the top-k context would add to the generation
+                      prompt (estimated as characters / 4)
+plus latency percentiles, as JSON for trend tracking.
+
+Backends:
+    kb        managed Bedrock Knowledge Base (retrieve API)
+    pgvector  direct cosine search on bedrock_integration.bedrock_kb
+    hybrid    pgvector + Postgres full-text search, merged with reciprocal rank fusion
+    local     BM25 over the bundled spec sheets (eval/corpus.jsonl), no AWS needed
+
+pgvector and hybrid go through the RDS Data API by default, or through a
+local Postgres with --dsn (needs the psycopg package). Question embeddings
+are cached in eval/embeddings.json, so once recorded --dsn runs offline.
+
+Recordings make the suite runnable offline:
+    python retrieval_eval.py --mode record --recordings eval/recordings.json
+    python retrieval_eval.py --mode replay --recordings eval/recordings.json --output eval/report.json
+
+Replay runs every backend in the recordings unless --backends is given. The
+committed eval/recordings.json is a baseline for the local backend, recorded with:
+    python retrieval_eval.py --build-corpus scripts/spec-sheets
+    python retrieval_eval.py --backends local --mode record
+
+Latency is measured once per question at the largest k and reused for the
+smaller k values.
+"""
+import argparse
+import json
+import math
+import os
+import re
+import time
+
+from bedrock_utils import build_prompt, get_bedrock_client, get_bedrock_kb_client, get_session
+from run_sql_setup import CLUSTER_ARN, DATABASE_NAME, SECRET_ARN
+
+DEFAULT_KB_ID = "DU9AYF1KM2"
+DEFAULT_GOLD_SET = os.path.join("eval", "gold_set.json")
+DEFAULT_CORPUS = os.path.join("eval", "corpus.jsonl")
+BACKEND_NAMES = ('kb', 'pgvector', 'hybrid', 'local')
+# Must match the embedding model of the Knowledge Base (modules/bedrock_kb/main.tf)
+EMBEDDING_MODEL_ID = "amazon.titan-embed-text-v1"
+# Reciprocal rank fusion constant
+RRF_K = 60
+# Corpus chunks approximate the Knowledge Base default chunking (300 tokens, 20% overlap)
+CHUNK_CHARS = 1200
+CHUNK_OVERLAP_CHARS = 240
+# BM25 parameters
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+def source_name(uri):
+    """Spec sheet file name from an S3 URI or path"""
+    return uri.rstrip('/').rsplit('/', 1)[-1] if uri else ''
+
+class KnowledgeBaseBackend:
+    """Managed Bedrock Knowledge Base retrieval"""
+
+    name = 'kb'
+
+    def __init__(self, kb_id):
+        self.kb_id = kb_id
+
+    def search(self, question, k):
+        # Straight to the client, bypassing the shared result cache
+        response = get_bedrock_kb_client().retrieve(
+            knowledgeBaseId=self.kb_id,
+            retrievalQuery={'text': question},
+            retrievalConfiguration={'vectorSearchConfiguration': {'numberOfResults': k}}
+        )
+        return [{
+            'text': result.get('content', {}).get('text', ''),
+            'source': source_name(result.get('location', {}).get('s3Location', {}).get('uri')),
+            'score': result.get('score'),
+        } for result in response.get('retrievalResults', [])]
+
+class DataApiRunner:
+    """Runs SQL on Aurora through the RDS Data API"""
+
+    def __init__(self, session, cluster_arn=CLUSTER_ARN, secret_arn=SECRET_ARN, database=DATABASE_NAME):
+        self.rds_data = session.client('rds-data', region_name='us-east-1')
+        self.cluster_arn = cluster_arn
+        self.secret_arn = secret_arn
+        self.database = database
+
+    def query(self, sql, params):
+        parameters = []
+        for name, value in params.items():
+            field = {'longValue': value} if isinstance(value, int) else {'stringValue': value}
+            parameters.append({'name': name, 'value': field})
+        response = self.rds_data.execute_statement(
+            resourceArn=self.cluster_arn,
+            secretArn=self.secret_arn,
+            database=self.database,
+            sql=sql,
+            parameters=parameters
+        )
+        rows = []
+        for record in response.get('records', []):
+            rows.append([next(iter(field.values())) if not field.get('isNull') else None for field in record])
+        return rows
+
+class PsycopgRunner:
+    """Runs SQL on a local Postgres with pgvector"""
+
+    def __init__(self, dsn):
+        try:
+            import psycopg
+        except ImportError:
+            raise Exception("The psycopg package is required for --dsn. Install it with: pip install psycopg")
+        self.conn = psycopg.connect(dsn, autocommit=True)
+
+    def query(self, sql, params):
+        # The SQL uses Data API style :name placeholders
+        sql = re.sub(r':(\w+)', r'%(\1)s', sql)
+        with self.conn.cursor() as cursor:
+            cursor.execute(sql, params)
+            return [list(row) for row in cursor.fetchall()]
+
+VECTOR_SQL = """SELECT chunks, CAST(metadata AS text), embedding <=> CAST(:embedding AS vector) AS distance
+FROM bedrock_integration.bedrock_kb
+ORDER BY distance
+LIMIT :k"""
+
+TEXT_SQL = """SELECT chunks, CAST(metadata AS text),
+    ts_rank(to_tsvector('english', chunks), plainto_tsquery('english', :query)) AS rank
+FROM bedrock_integration.bedrock_kb
+WHERE to_tsvector('english', chunks) @@ plainto_tsquery('english', :query)
+ORDER BY rank DESC
+LIMIT :k"""
+
+def _row_result(row, score):
+    text, metadata, _ = row
+    try:
+        metadata = json.loads(metadata) if metadata else {}
+    except ValueError:
+        metadata = {}
+    return {'text': text or '', 'source': source_name(metadata.get('x-amz-bedrock-kb-source-uri', '')), 'score': score}
+
+class PgvectorBackend:
+    """Direct cosine similarity search on the Knowledge Base vector table"""
+
+    name = 'pgvector'
+
+    def __init__(self, runner, embeddings=None):
+        self.runner = runner
+        # Question embeddings keyed by "<model>|<question>", shared with the embeddings file
+        self.embeddings = embeddings if embeddings is not None else {}
+
+    def embed(self, question):
+        key = f"{EMBEDDING_MODEL_ID}|{question}"
+        if key not in self.embeddings:
+            response = get_bedrock_client().invoke_model(
+                modelId=EMBEDDING_MODEL_ID,
+                contentType='application/json',
+                accept='application/json',
+                body=json.dumps({'inputText': question})
+            )
+            self.embeddings[key] = json.loads(response['body'].read())['embedding']
+        return self.embeddings[key]
+
+    def vector_search(self, question, k):
+        embedding = "[" + ",".join(str(value) for value in self.embed(question)) + "]"
+        rows = self.runner.query(VECTOR_SQL, {'embedding': embedding, 'k': k})
+        return [_row_result(row, 1 - float(row[2])) for row in rows]
+
+    def search(self, question, k):
+        return self.vector_search(question, k)
+
+class HybridBackend(PgvectorBackend):
+    """pgvector search merged with Postgres full-text search by reciprocal rank fusion"""
+
+    name = 'hybrid'
+
+    def search(self, question, k):
+        depth = max(k * 2, 10)
+        vector_results = self.vector_search(question, depth)
+        text_rows = self.runner.query(TEXT_SQL, {'query': question, 'k': depth})
+        text_results = [_row_result(row, float(row[2])) for row in text_rows]
+
+        fused = {}
+        for results in (vector_results, text_results):
+            for rank, result in enumerate(results, 1):
+                entry = fused.setdefault(result['text'], dict(result, score=0.0))
+                entry['score'] += 1 / (RRF_K + rank)
+        return sorted(fused.values(), key=lambda result: result['score'], reverse=True)[:k]
+
+def tokenize(text):
+    return re.findall(r'\w+', text.lower())
+
+class LocalBackend:
+    """BM25 search over the spec sheet chunks in the corpus file"""
+
+    name = 'local'
+
+    def __init__(self, corpus_path=DEFAULT_CORPUS):
+        if not os.path.exists(corpus_path):
+            raise Exception(f"{corpus_path} not found; build it with --build-corpus scripts/spec-sheets")
+        self.chunks = []
+        with open(corpus_path, encoding='utf-8') as f:
+            for line in f:
+                chunk = json.loads(line)
+                chunk['terms'] = tokenize(chunk['text'])
+                self.chunks.append(chunk)
+        self.avg_length = sum(len(chunk['terms']) for chunk in self.chunks) / len(self.chunks)
+        self.doc_freq = {}
+        for chunk in self.chunks:
+            for term in set(chunk['terms']):
+                self.doc_freq[term] = self.doc_freq.get(term, 0) + 1
+
+    def score(self, query_terms, chunk):
+        count = len(self.chunks)
+        score = 0.0
+        for term in set(query_terms):
+            freq = chunk['terms'].count(term)
+            if not freq:
+                continue
+            idf = math.log(1 + (count - self.doc_freq[term] + 0.5) / (self.doc_freq[term] + 0.5))
+            norm = BM25_K1 * (1 - BM25_B + BM25_B * len(chunk['terms']) / self.avg_length)
+            score += idf * freq * (BM25_K1 + 1) / (freq + norm)
+        return score
+
+    def search(self, question, k):
+        query_terms = tokenize(question)
+        scored = [(self.score(query_terms, chunk), chunk) for chunk in self.chunks]
+        scored = sorted((item for item in scored if item[0] > 0), key=lambda item: item[0], reverse=True)
+        return [{'text': chunk['text'], 'source': chunk['source'], 'score': round(score, 4)}
+                for score, chunk in scored[:k]]
+
+def chunk_lines(lines):
+    """Groups lines into chunks of up to CHUNK_CHARS, overlapping by about CHUNK_OVERLAP_CHARS"""
+    chunks, current = [], []
+    for line in lines:
+        if current and len("\n".join(current + [line])) > CHUNK_CHARS:
+            chunks.append("\n".join(current))
+            overlap = []
+            for previous in reversed(current):
+                if len("\n".join([previous] + overlap)) > CHUNK_OVERLAP_CHARS:
+                    break
+                overlap.insert(0, previous)
+            current = overlap
+        current.append(line)
+    if current:
+        chunks.append("\n".join(current))
+    return chunks
+
+def build_corpus(pdf_dir, corpus_path=DEFAULT_CORPUS):
+    """Extracts and chunks the spec sheet PDFs for the local backend"""
+    try:
+        import pypdf
+    except ImportError:
+        raise Exception("The pypdf package is required for --build-corpus. Install it with: pip install pypdf")
+    count = 0
+    with open(corpus_path, 'w', encoding='utf-8') as f:
+        for file_name in sorted(os.listdir(pdf_dir)):
+            if not file_name.endswith('.pdf'):
+                continue
+            reader = pypdf.PdfReader(os.path.join(pdf_dir, file_name))
+            text = "\n".join(page.extract_text() or '' for page in reader.pages)
+            lines = [line.strip() for line in text.splitlines() if line.strip()]
+            for chunk in chunk_lines(lines):
+                f.write(json.dumps({'source': file_name, 'text': chunk}) + "\n")
+                count += 1
+    print(f"Wrote {count} chunks to {corpus_path}")
+
+class RecordedBackend:
+    """
+    Wraps a backend to record its results and latencies to a JSON file, or
+    to replay them without touching AWS or the database.
+    """
+
+    def __init__(self, backend, recordings, mode, name=None):
+        self.backend = backend
+        self.name = name or backend.name
+        self.recordings = recordings
+        self.mode = mode
+
+    def search_timed(self, question, k):
+        """Returns (results, latency_ms)"""
+        key = f"{self.name}|{k}|{question}"
+        if self.mode == 'replay':
+            if key not in self.recordings:
+                raise Exception(f"No recording for {key}; run with --mode record first")
+            recording = self.recordings[key]
+            return recording['results'], recording['latency_ms']
+        start = time.perf_counter()
+        results = self.backend.search(question, k)
+        latency_ms = round((time.perf_counter() - start) * 1000, 1)
+        if self.mode == 'record':
+            self.recordings[key] = {'results': results, 'latency_ms': latency_ms}
+        return results, latency_ms
+
+def is_relevant(result, item):
+    """A result is relevant if it comes from an expected spec sheet (and contains an expected chunk, if any)"""
+    if result['source'] not in item['expected_sources']:
+        return False
+    expected_chunks = item.get('expected_chunks')
+    if not expected_chunks:
+        return True
+    text = result['text'].lower()
+    return any(chunk.lower() in text for chunk in expected_chunks)
+
+def percentile(values, pct):
+    """Nearest-rank percentile of a list of numbers"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[max(0, min(len(ordered) - 1, math.ceil(pct / 100 * len(ordered)) - 1))]
+
+def evaluate(backend, items, k_values):
+    """Runs the gold set against one backend and returns its metrics"""
+    max_k = max(k_values)
+    latencies = []
+    totals = {k: {'recall': 0.0, 'mrr': 0.0, 'input_tokens_est': 0} for k in k_values}
+    misses = []
+
+    for item in items:
+        results, latency_ms = backend.search_timed(item['question'], max_k)
+        latencies.append(latency_ms)
+        for k in k_values:
+            top = results[:k]
+            found = {result['source'] for result in top if is_relevant(result, item)}
+            totals[k]['recall'] += len(found) / len(item['expected_sources'])
+            first_rank = next((rank for rank, result in enumerate(top, 1) if is_relevant(result, item)), None)
+            totals[k]['mrr'] += 1 / first_rank if first_rank else 0.0
+            context = "\n".join(result['text'] for result in top if result['text'])
+            totals[k]['input_tokens_est'] += len(build_prompt(context, item['question'])) // 4
+        if not any(is_relevant(result, item) for result in results):
+            misses.append(item['id'])
+
+    count = len(items)
+    return {
+        'questions': count,
+        'latency_ms': {
+            'p50': round(percentile(latencies, 50), 1),
+            'p95': round(percentile(latencies, 95), 1),
+            'p99': round(percentile(latencies, 99), 1),
+            'mean': round(sum(latencies) / count, 1) if count else 0.0,
+        },
+        'at_k': {
+            str(k): {
+                'recall': round(totals[k]['recall'] / count, 3) if count else 0.0,
+                'mrr': round(totals[k]['mrr'] / count, 3) if count else 0.0,
+                'input_tokens_est': round(totals[k]['input_tokens_est'] / count) if count else 0,
+            } for k in k_values
+        },
+        'missed_at_max_k': misses,
+    }
+
+def build_backends(names, kb_id, dsn, embeddings, corpus_path):
+    """Creates the live backends selected on the command line"""
+    backends = []
+    runner = None
+    for name in names:
+        if name == 'kb':
+            backends.append(KnowledgeBaseBackend(kb_id))
+            continue
+        if name == 'local':
+            backends.append(LocalBackend(corpus_path))
+            continue
+        if runner is None:
+            runner = PsycopgRunner(dsn) if dsn else DataApiRunner(get_session())
+        backend_class = PgvectorBackend if name == 'pgvector' else HybridBackend
+        backends.append(backend_class(runner, embeddings))
+    return backends
+
+def load_json(path, default):
+    if not os.path.exists(path):
+        return default
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+def main():
+    parser = argparse.ArgumentParser(description="Retrieval quality and latency regression suite")
+    parser.add_argument('--gold-set', default=DEFAULT_GOLD_SET)
+    parser.add_argument('--backends', help="Comma-separated: kb, pgvector, hybrid, local "
+                        "(default: kb, or every recorded backend in replay mode)")
+    parser.add_argument('--k', default='1,3,5', help="Comma-separated k values")
+    parser.add_argument('--kb-id', default=DEFAULT_KB_ID)
+    parser.add_argument('--dsn', help="Local Postgres DSN for pgvector/hybrid instead of the RDS Data API")
+    parser.add_argument('--mode', choices=['live', 'record', 'replay'], default='live')
+    parser.add_argument('--recordings', default=os.path.join('eval', 'recordings.json'))
+    parser.add_argument('--embeddings', default=os.path.join('eval', 'embeddings.json'),
+                        help="Question embedding cache for pgvector/hybrid")
+    parser.add_argument('--corpus', default=DEFAULT_CORPUS, help="Chunked spec sheets for the local backend")
+    parser.add_argument('--build-corpus', metavar='PDF_DIR',
+                        help="Extract and chunk the PDFs in PDF_DIR into --corpus, then exit")
+    parser.add_argument('--output', help="Also write the JSON report to this file")
+    args = parser.parse_args()
+
+    if args.build_corpus:
+        build_corpus(args.build_corpus, args.corpus)
+        return
+
+    recordings = {}
+    if args.mode == 'replay' or (args.mode == 'record' and os.path.exists(args.recordings)):
+        if not os.path.exists(args.recordings):
+            parser.error(f"{args.recordings} not found; run with --mode record first")
+        recordings = load_json(args.recordings, {})
+
+    if args.backends:
+        names = [name.strip() for name in args.backends.split(',') if name.strip()]
+    elif args.mode == 'replay':
+        names = sorted({key.split('|', 1)[0] for key in recordings})
+    else:
+        names = ['kb']
+    unknown = [name for name in names if name not in BACKEND_NAMES]
+    if unknown:
+        parser.error(f"Unknown backends: {', '.join(unknown)}")
+    k_values = sorted({int(k) for k in args.k.split(',')})
+
+    with open(args.gold_set, encoding='utf-8') as f:
+        items = json.load(f)['items']
+
+    embeddings = load_json(args.embeddings, {})
+    embedding_count = len(embeddings)
+    if args.mode == 'replay':
+        backends = [RecordedBackend(None, recordings, 'replay', name=name) for name in names]
+    else:
+        backends = [RecordedBackend(backend, recordings, args.mode)
+                    for backend in build_backends(names, args.kb_id, args.dsn, embeddings, args.corpus)]
+
+    report = {
+        'generated_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'gold_set': args.gold_set,
+        'mode': args.mode,
+        'k_values': k_values,
+        'backends': {backend.name: evaluate(backend, items, k_values) for backend in backends},
+    }
+
+    if args.mode == 'record':
+        with open(args.recordings, 'w', encoding='utf-8') as f:
+            json.dump(recordings, f, indent=2)
+    if len(embeddings) > embedding_count:
+        with open(args.embeddings, 'w', encoding='utf-8') as f:
+            json.dump(embeddings, f)
+
+    output = json.dumps(report, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(output)
+
+if __name__ == "__main__":
+    main()
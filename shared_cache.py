@@ -0,0 +1,271 @@
+"""
+Shared cache for classification, retrieval and answer results.
+
+Every Streamlit replica points at the same backend, so a question answered by
+one replica is a cache hit on all the others. The backend is picked with the
+BEDROCK_CACHE_URL environment variable:
+    sqlite:///path/to/cache.sqlite3  - file shared by processes on one host (default)
+    redis://host:6379/0              - shared across hosts (needs the redis package)
+    none                             - disable caching
+"""
+import atexit
+import hashlib
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+DEFAULT_CACHE_URL = "sqlite:///.bedrock_cache.sqlite3"
+
+# Bump when the cached value format changes so old entries are ignored
+KEY_VERSION = "v1"
+
+# Time-to-live per namespace, in seconds
+TTL_SECONDS = {
+    'classify': 24 * 3600,   # categories only change with the prompt template
+    'retrieve': 3600,        # the KB can be re-synced at any time
+    'answer': 3600,
+}
+
+# Answers from batch runs are generated offline and meant to be served until the next run
+BATCH_ANSWER_TTL_SECONDS = 30 * 24 * 3600
+
+REPLICA_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+# Hit/miss counts are batched in memory and written to the backend at most this often
+STATS_FLUSH_SECONDS = 10
+
+_cache = None
+_cache_lock = threading.Lock()
+_replica_stats = {}
+_pending_stats = {}
+_last_flush = time.monotonic()
+_stats_lock = threading.Lock()
+
+def make_key(namespace, *parts):
+    """Build a cache key: bedrock:<version>:<namespace>:<sha256 of parts>"""
+    payload = json.dumps(parts, sort_keys=True, default=str)
+    digest = hashlib.sha256(payload.encode('utf-8')).hexdigest()
+    return f"bedrock:{KEY_VERSION}:{namespace}:{digest}"
+
+def normalize_text(text):
+    """Collapse whitespace and case so trivially different prompts share a key"""
+    return " ".join(text.split()).lower()
+
+class SQLiteCache:
+    """Cache stored in a SQLite file, safe to share between processes on one host"""
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._writes = 0
+        conn = self._connect()
+        conn.execute("PRAGMA journal_mode=WAL;")
+        conn.execute("""CREATE TABLE IF NOT EXISTS cache (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL,
+            expires_at REAL NOT NULL
+        )""")
+        conn.execute("""CREATE TABLE IF NOT EXISTS cache_stats (
+            namespace TEXT NOT NULL,
+            event TEXT NOT NULL,
+            count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (namespace, event)
+        )""")
+        conn.commit()
+
+    def _connect(self):
+        # sqlite3 connections can't be shared between threads, and Streamlit
+        # serves each session on its own thread
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5)
+            self._local.conn = conn
+        return conn
+
+    def get(self, key):
+        row = self._connect().execute(
+            "SELECT value FROM cache WHERE key = ? AND expires_at > ?",
+            (key, time.time())
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set(self, key, value, ttl):
+        conn = self._connect()
+        conn.execute(
+            "INSERT OR REPLACE INTO cache (key, value, expires_at) VALUES (?, ?, ?)",
+            (key, json.dumps(value), time.time() + ttl)
+        )
+        self._writes += 1
+        if self._writes % 500 == 0:
+            conn.execute("DELETE FROM cache WHERE expires_at <= ?", (time.time(),))
+        conn.commit()
+
+    def incr_stats(self, deltas):
+        """Adds {(namespace, event): count} to the global counters in one transaction"""
+        conn = self._connect()
+        conn.executemany(
+            """INSERT INTO cache_stats (namespace, event, count) VALUES (?, ?, ?)
+            ON CONFLICT (namespace, event) DO UPDATE SET count = count + excluded.count""",
+            [(namespace, event, count) for (namespace, event), count in deltas.items()]
+        )
+        conn.commit()
+
+    def global_stats(self):
+        stats = {}
+        for namespace, event, count in self._connect().execute(
+                "SELECT namespace, event, count FROM cache_stats"):
+            stats.setdefault(namespace, {'hits': 0, 'misses': 0})[event] = count
+        return stats
+
+class RedisCache:
+    """Cache stored in Redis, shared by replicas on any host"""
+
+    STATS_KEY = f"bedrock:{KEY_VERSION}:stats"
+
+    def __init__(self, url):
+        try:
+            import redis
+        except ImportError:
+            raise Exception("The redis package is required for redis:// cache URLs. Install it with: pip install redis")
+        self.client = redis.Redis.from_url(url)
+
+    def get(self, key):
+        value = self.client.get(key)
+        return json.loads(value) if value is not None else None
+
+    def set(self, key, value, ttl):
+        self.client.setex(key, int(ttl), json.dumps(value))
+
+    def incr_stats(self, deltas):
+        """Adds {(namespace, event): count} to the global counters"""
+        pipeline = self.client.pipeline()
+        for (namespace, event), count in deltas.items():
+            pipeline.hincrby(self.STATS_KEY, f"{namespace}:{event}", count)
+        pipeline.execute()
+
+    def global_stats(self):
+        stats = {}
+        for field, count in self.client.hgetall(self.STATS_KEY).items():
+            namespace, event = field.decode('utf-8').rsplit(':', 1)
+            stats.setdefault(namespace, {'hits': 0, 'misses': 0})[event] = int(count)
+        return stats
+
+def create_cache(url):
+    """Create a cache backend from a URL, or return None if caching is disabled"""
+    if not url or url.lower() == 'none':
+        return None
+    if url.startswith('sqlite:///'):
+        return SQLiteCache(url[len('sqlite:///'):])
+    if url.startswith(('redis://', 'rediss://', 'unix://')):
+        return RedisCache(url)
+    raise ValueError(f"Unsupported cache URL: {url}")
+
+def get_shared_cache():
+    """Get or create the process-wide cache backend configured by BEDROCK_CACHE_URL"""
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                try:
+                    _cache = create_cache(os.environ.get('BEDROCK_CACHE_URL', DEFAULT_CACHE_URL)) or False
+                except Exception as e:
+                    # Run uncached rather than failing every request; don't retry per call
+                    print(f"Error creating shared cache, running without it: {e}")
+                    _cache = False
+    return _cache or None
+
+def flush_stats():
+    """Writes the hit/miss counts batched since the last flush to the backend"""
+    global _pending_stats, _last_flush
+    cache = get_shared_cache()
+    with _stats_lock:
+        deltas, _pending_stats = _pending_stats, {}
+        _last_flush = time.monotonic()
+    if cache is None or not deltas:
+        return
+    try:
+        cache.incr_stats(deltas)
+    except Exception as e:
+        print(f"Error updating cache stats: {e}")
+
+atexit.register(flush_stats)
+
+def _record(namespace, event):
+    # Counting stays in memory so a cache hit never waits on a backend write
+    with _stats_lock:
+        counts = _replica_stats.setdefault(namespace, {'hits': 0, 'misses': 0})
+        counts[event] += 1
+        key = (namespace, event)
+        _pending_stats[key] = _pending_stats.get(key, 0) + 1
+        due = time.monotonic() - _last_flush >= STATS_FLUSH_SECONDS
+    if due:
+        flush_stats()
+
+def lookup(namespace, key_parts):
+    """Returns the cached value for key_parts in namespace, or None on a miss"""
+    cache = get_shared_cache()
+    if cache is None:
+        return None
+    try:
+        value = cache.get(make_key(namespace, *key_parts))
+    except Exception as e:
+        print(f"Error reading shared cache: {e}")
+        return None
+    _record(namespace, 'hits' if value is not None else 'misses')
+    return value
+
+def store(namespace, key_parts, value, ttl=None):
+    """Stores value for key_parts in namespace, by default with the namespace TTL"""
+    cache = get_shared_cache()
+    if cache is None:
+        return
+    try:
+        cache.set(make_key(namespace, *key_parts), value, ttl or TTL_SECONDS[namespace])
+    except Exception as e:
+        print(f"Error writing shared cache: {e}")
+
+def get_or_compute(namespace, key_parts, compute, should_cache=bool):
+    """
+    Returns the cached value for key_parts in namespace, or calls compute()
+    and stores its result. Values for which should_cache() is false (errors,
+    empty results) are returned but not stored. Cache backend failures never
+    fail the request; they just fall through to compute().
+    """
+    value = lookup(namespace, key_parts)
+    if value is not None:
+        return value
+    value = compute()
+    if should_cache(value):
+        store(namespace, key_parts, value)
+    return value
+
+def _with_hit_rate(stats):
+    result = {}
+    for namespace, counts in stats.items():
+        total = counts.get('hits', 0) + counts.get('misses', 0)
+        result[namespace] = dict(counts, hit_rate=round(counts.get('hits', 0) / total, 3) if total else 0.0)
+    return result
+
+def cache_stats():
+    """
+    Returns hit/miss counts and hit rates for this replica and across all
+    replicas. Other replicas' counts lag by up to STATS_FLUSH_SECONDS.
+    """
+    flush_stats()
+    cache = get_shared_cache()
+    with _stats_lock:
+        replica = {namespace: dict(counts) for namespace, counts in _replica_stats.items()}
+    global_stats = {}
+    if cache is not None:
+        try:
+            global_stats = cache.global_stats()
+        except Exception as e:
+            print(f"Error reading cache stats: {e}")
+    return {
+        'replica_id': REPLICA_ID,
+        'replica': _with_hit_rate(replica),
+        'global': _with_hit_rate(global_stats),
+    }
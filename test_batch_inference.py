@@ -0,0 +1,205 @@
+"""
+Crash/resume tests for batch_inference.py. Everything runs offline against an
+in-memory S3, FakeBedrockRuntime and fake retrievers.
+
+Run with:
+    python -m unittest test_batch_inference
+"""
+import os
+import shutil
+import tempfile
+import unittest
+
+os.environ['BEDROCK_CACHE_URL'] = 'none'
+
+try:
+    import batch_inference
+except ImportError:  # boto3/botocore not installed
+    batch_inference = None
+
+class Crash(Exception):
+    """Simulated process crash"""
+
+class Throttled(Exception):
+    """Simulated transient Knowledge Base error"""
+
+class FakeBody:
+    def __init__(self, data):
+        self.data = data
+
+    def iter_lines(self):
+        return iter(self.data.splitlines())
+
+    def read(self):
+        return self.data
+
+class FakeS3:
+    """Just enough of the S3 client for batch_inference"""
+
+    def __init__(self):
+        self.objects = {}
+
+    def upload_file(self, path, bucket, key):
+        with open(path, 'rb') as f:
+            self.objects[(bucket, key)] = f.read()
+
+    def put_object(self, Bucket, Key, Body):
+        self.objects[(Bucket, Key)] = Body
+
+    def get_object(self, Bucket, Key):
+        return {'Body': FakeBody(self.objects[(Bucket, Key)])}
+
+    def get_paginator(self, name):
+        return self
+
+    def paginate(self, Bucket, Prefix):
+        keys = sorted(key for bucket, key in self.objects if bucket == Bucket and key.startswith(Prefix))
+        yield {'Contents': [{'Key': key} for key in keys]}
+
+class FakeBatchService:
+    """Bedrock Batch Inference stand-in: job names are unique, like the real service"""
+
+    def __init__(self, s3):
+        self.runner = batch_inference.LocalJobRunner(s3, batch_inference.FakeBedrockRuntime())
+        self.submitted = 0
+        self.crash_after_submit = False
+
+    def find(self, job_name):
+        return self.runner.find(job_name)
+
+    def submit(self, job_name, model_id, input_uri, output_uri):
+        if self.runner.find(job_name):
+            raise Exception(f"ConflictException: job name {job_name} already exists")
+        self.submitted += 1
+        job_arn = self.runner.submit(job_name, model_id, input_uri, output_uri)
+        if self.crash_after_submit:
+            raise Crash("crashed before the job ARN was checkpointed")
+        return job_arn
+
+    def status(self, job_arn):
+        return 'Completed', ''
+
+def retriever(crash_after=None, no_context=(), fail_on=()):
+    """Fake retriever that can crash after a number of calls or fail on some questions"""
+    calls = []
+
+    def retrieve(query, kb_id):
+        if crash_after is not None and len(calls) >= crash_after:
+            raise Crash("crashed during prepare")
+        if query in fail_on:
+            raise Throttled("ThrottlingException: rate exceeded")
+        calls.append(query)
+        if query in no_context:
+            return []
+        return batch_inference.fake_retrieve(query, kb_id)
+    retrieve.calls = calls
+    return retrieve
+
+@unittest.skipIf(batch_inference is None, "boto3 is not installed")
+class RunBatchResumeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.questions = [f"What is the engine power of machine {i}?" for i in range(10)]
+        self.questions_path = os.path.join(self.tmp, 'questions.txt')
+        with open(self.questions_path, 'w') as f:
+            f.write("\n".join(self.questions))
+        self.s3 = FakeS3()
+        self.service = FakeBatchService(self.s3)
+        self.stored = []
+        self._store = batch_inference.store
+        batch_inference.store = lambda *args, **kwargs: self.stored.append((args, kwargs))
+
+    def tearDown(self):
+        batch_inference.store = self._store
+        shutil.rmtree(self.tmp)
+
+    def run_batch(self, retrieve):
+        return batch_inference.run_batch(
+            self.questions_path, 'test', 'bucket', self.service, self.s3,
+            os.path.join(self.tmp, 'work'), 'model', 'kb',
+            results_db_path=os.path.join(self.tmp, 'results.sqlite3'), retrieve=retrieve)
+
+    def results(self):
+        db = batch_inference.open_results_db(os.path.join(self.tmp, 'results.sqlite3'))
+        try:
+            return db.execute("SELECT question, answer, error FROM batch_results WHERE run_id = 'test'").fetchall()
+        finally:
+            db.close()
+
+    def test_resume_after_crash_in_prepare(self):
+        with self.assertRaises(Crash):
+            self.run_batch(retriever(crash_after=4))
+        resumed = retriever()
+        state = self.run_batch(resumed)
+
+        self.assertEqual(state['stage'], 'done')
+        # Only the questions not prepared before the crash are retrieved again
+        self.assertEqual(resumed.calls, self.questions[4:])
+        prepared = batch_inference.read_jsonl(os.path.join(self.tmp, 'work', 'prepared.jsonl'))
+        self.assertEqual(sorted(row['question'] for row in prepared), sorted(self.questions))
+        self.assertEqual(len(self.results()), len(self.questions))
+
+    def test_resume_after_transient_retrieve_error(self):
+        failed = self.questions[3]
+        with self.assertRaises(Throttled):
+            self.run_batch(retriever(fail_on=[failed]))
+        resumed = retriever()
+        state = self.run_batch(resumed)
+
+        self.assertEqual(state['stage'], 'done')
+        # The failed question is retried, not recorded as having no context
+        self.assertEqual(resumed.calls, self.questions[3:])
+        results = {question: (answer, error) for question, answer, error in self.results()}
+        self.assertEqual(len(results), len(self.questions))
+        self.assertIsNotNone(results[failed][0])
+        self.assertIsNone(results[failed][1])
+
+    def test_resume_after_crash_in_ingest(self):
+        stored_before_crash = []
+
+        def crashing_store(*args, **kwargs):
+            if len(stored_before_crash) == 3:
+                raise Crash("crashed during ingest")
+            stored_before_crash.append(args)
+        batch_inference.store = crashing_store
+        with self.assertRaises(Crash):
+            self.run_batch(retriever())
+        self.assertEqual(len(self.results()), 3)
+
+        batch_inference.store = lambda *args, **kwargs: self.stored.append((args, kwargs))
+        state = self.run_batch(retriever())
+
+        self.assertEqual(state['stage'], 'done')
+        self.assertEqual(self.service.submitted, 1)
+        results = self.results()
+        self.assertEqual(sorted(question for question, _, _ in results), sorted(self.questions))
+        self.assertTrue(all(answer and error is None for _, answer, error in results))
+        # Records ingested before the crash aren't stored again
+        self.assertEqual(len(self.stored), len(self.questions) - 3)
+        self.assertEqual(self.stored[0][1]['ttl'], batch_inference.BATCH_ANSWER_TTL_SECONDS)
+
+    def test_resume_after_crash_between_submit_and_checkpoint(self):
+        self.service.crash_after_submit = True
+        with self.assertRaises(Crash):
+            self.run_batch(retriever())
+        self.service.crash_after_submit = False
+        state = self.run_batch(retriever())
+
+        self.assertEqual(state['stage'], 'done')
+        self.assertEqual(state['job_name'], 'bulk-qa-test')
+        self.assertEqual(self.service.submitted, 1)
+        self.assertEqual(len(self.results()), len(self.questions))
+
+    def test_questions_without_context_are_not_submitted(self):
+        skipped = self.questions[:2]
+        state = self.run_batch(retriever(no_context=skipped))
+
+        self.assertEqual(state['stage'], 'done')
+        body = self.s3.objects[('bucket', 'batch/test/input/records.jsonl')]
+        self.assertEqual(len(body.splitlines()), len(self.questions) - 2)
+        errors = {question: error for question, answer, error in self.results() if error}
+        self.assertEqual(errors, {question: batch_inference.NO_CONTEXT_ERROR for question in skipped})
+
+if __name__ == '__main__':
+    unittest.main()
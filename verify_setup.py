@@ -1,19 +1,54 @@
 """
 Verification script to check project setup status
+
+Usage:
+    python verify_setup.py                 # human-readable walkthrough
+    python verify_setup.py --json          # concurrent health checks, JSON report
+    python verify_setup.py --json --checks credentials,retrieval --timeout 0.5
+
+In --json mode all probes run in parallel on one shared session with
+per-probe timeouts, and the exit code is non-zero if any check fails, so it
+can be used as a Kubernetes readiness or liveness probe. The default 0.8s
+timeout keeps it under the default 1s timeoutSeconds; raise timeoutSeconds
+along with --timeout, leaving room for interpreter start-up and client setup.
 """
+import argparse
 import boto3
+from botocore.config import Config
 from botocore.exceptions import ClientError, ProfileNotFound
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 import json
 import os
+import sys
+import time
 
 # Force use of default profile
 os.environ.pop('AWS_PROFILE', None)
 
+S3_BUCKET = "bedrock-kb-401040007987"
+RDS_CLUSTER = "my-aurora-serverless"
+KB_ID = "DU9AYF1KM2"
+CLUSTER_ARN = "arn:aws:rds:us-east-1:401040007987:cluster:my-aurora-serverless"
+SECRET_ARN = "arn:aws:secretsmanager:us-east-1:401040007987:secret:auroraserverlessdb-KQc4kG"
+DATABASE_NAME = "myapp"
+REGION = "us-east-1"
+# Below Kubernetes' default 1s probe timeoutSeconds
+DEFAULT_PROBE_TIMEOUT = 0.8
+
+_session = None
+
+def get_session():
+    """Get or create the boto3 session shared by every check"""
+    global _session
+    if _session is None:
+        # Explicitly use default profile
+        _session = boto3.Session(profile_name='default')
+    return _session
+
 def check_aws_credentials():
     """Verify AWS credentials are configured"""
     try:
-        # Explicitly use default profile
-        session = boto3.Session(profile_name='default')
+        session = get_session()
         sts = session.client('sts')
         identity = sts.get_caller_identity()
         print(f"[OK] AWS Credentials: Valid")
@@ -32,7 +67,7 @@ def check_aws_credentials():
 def check_s3_bucket(bucket_name):
     """Check if S3 bucket exists and is accessible"""
     try:
-        session = boto3.Session(profile_name='default')
+        session = get_session()
         s3 = session.client('s3')
         s3.head_bucket(Bucket=bucket_name)
         print(f"[OK] S3 Bucket: {bucket_name} exists")
@@ -53,7 +88,7 @@ def check_s3_bucket(bucket_name):
 def check_rds_cluster(cluster_identifier):
     """Check if RDS cluster exists"""
     try:
-        session = boto3.Session(profile_name='default')
+        session = get_session()
         rds = session.client('rds')
         response = rds.describe_db_clusters(DBClusterIdentifier=cluster_identifier)
         cluster = response['DBClusters'][0]
@@ -70,7 +105,7 @@ def check_rds_cluster(cluster_identifier):
 def check_bedrock_kb(kb_id=None):
     """Check if Bedrock Knowledge Base exists"""
     try:
-        session = boto3.Session(profile_name='default')
+        session = get_session()
         bedrock = session.client('bedrock-agent', region_name='us-east-1')
         if kb_id:
             response = bedrock.get_knowledge_base(knowledgeBaseId=kb_id)
@@ -113,11 +148,11 @@ def main():
     print()
     
     # Check S3 bucket
-    check_s3_bucket("bedrock-kb-401040007987")
+    check_s3_bucket(S3_BUCKET)
     print()
     
     # Check RDS cluster
-    check_rds_cluster("my-aurora-serverless")
+    check_rds_cluster(RDS_CLUSTER)
     print()
     
     # Check Bedrock Knowledge Base
@@ -132,6 +167,128 @@ def main():
     print("2. If S3 has no files: Run python scripts/upload_s3.py")
     print("3. If KB exists: Get KB ID and update app.py")
 
+# Health checks for --json mode. Each probe takes the clients it needs and
+# returns a dict of details, raising on failure.
+
+def probe_credentials(clients):
+    identity = clients['sts'].get_caller_identity()
+    return {'account': identity.get('Account')}
+
+def probe_s3(clients):
+    clients['s3'].head_bucket(Bucket=S3_BUCKET)
+    return {'bucket': S3_BUCKET}
+
+def probe_rds(clients):
+    cluster = clients['rds'].describe_db_clusters(DBClusterIdentifier=RDS_CLUSTER)['DBClusters'][0]
+    if cluster['Status'] != 'available':
+        raise Exception(f"Cluster status is {cluster['Status']}")
+    return {'status': cluster['Status']}
+
+def probe_knowledge_base(clients):
+    kb = clients['bedrock-agent'].get_knowledge_base(knowledgeBaseId=KB_ID)['knowledgeBase']
+    if kb.get('status') != 'ACTIVE':
+        raise Exception(f"Knowledge Base status is {kb.get('status')}")
+    return {'status': kb.get('status')}
+
+def probe_retrieval(clients):
+    response = clients['bedrock-agent-runtime'].retrieve(
+        knowledgeBaseId=KB_ID,
+        retrievalQuery={'text': 'excavator engine power'},
+        retrievalConfiguration={'vectorSearchConfiguration': {'numberOfResults': 1}}
+    )
+    results = response.get('retrievalResults', [])
+    if not results:
+        raise Exception("Retrieval returned no results")
+    return {'results': len(results), 'top_score': results[0].get('score')}
+
+def probe_db_roundtrip(clients):
+    start = time.perf_counter()
+    clients['rds-data'].execute_statement(
+        resourceArn=CLUSTER_ARN,
+        secretArn=SECRET_ARN,
+        database=DATABASE_NAME,
+        sql="SELECT 1;"
+    )
+    return {'round_trip_ms': round((time.perf_counter() - start) * 1000, 1)}
+
+# check name -> (probe, clients it needs)
+PROBES = {
+    'credentials': (probe_credentials, ['sts']),
+    's3': (probe_s3, ['s3']),
+    'rds': (probe_rds, ['rds']),
+    'knowledge_base': (probe_knowledge_base, ['bedrock-agent']),
+    'retrieval': (probe_retrieval, ['bedrock-agent-runtime']),
+    'db_roundtrip': (probe_db_roundtrip, ['rds-data']),
+}
+
+def _timed_probe(probe, clients):
+    start = time.perf_counter()
+    try:
+        result = {'ok': True, 'detail': probe(clients)}
+    except Exception as e:
+        result = {'ok': False, 'error': str(e)}
+    result['duration_ms'] = round((time.perf_counter() - start) * 1000, 1)
+    return result
+
+def run_health_checks(checks=None, timeout=DEFAULT_PROBE_TIMEOUT):
+    """
+    Runs the selected probes concurrently and returns a JSON-serializable
+    report. A probe that doesn't finish within timeout seconds fails.
+    """
+    start = time.perf_counter()
+    checks = checks or list(PROBES)
+    # No retries and short socket timeouts, so a hung endpoint fails fast
+    config = Config(connect_timeout=timeout, read_timeout=timeout, retries={'max_attempts': 1})
+
+    report = {'checks': {}}
+    try:
+        # Client creation isn't thread-safe on a shared session, so build them up front
+        session = get_session()
+        clients = {}
+        for name in checks:
+            for service in PROBES[name][1]:
+                if service not in clients:
+                    clients[service] = session.client(service, region_name=REGION, config=config)
+    except Exception as e:
+        report['checks']['setup'] = {'ok': False, 'error': str(e), 'duration_ms': 0.0}
+        checks = []
+    report['setup_ms'] = round((time.perf_counter() - start) * 1000, 1)
+
+    executor = ThreadPoolExecutor(max_workers=max(len(checks), 1))
+    futures = {name: executor.submit(_timed_probe, PROBES[name][0], clients) for name in checks}
+    deadline = time.perf_counter() + timeout
+    for name, future in futures.items():
+        try:
+            report['checks'][name] = future.result(timeout=max(deadline - time.perf_counter(), 0))
+        except FutureTimeoutError:
+            report['checks'][name] = {'ok': False, 'error': f"Timed out after {timeout}s", 'duration_ms': timeout * 1000}
+    # Don't let a hung probe hold up the report
+    executor.shutdown(wait=False, cancel_futures=True)
+
+    report['ok'] = all(check['ok'] for check in report['checks'].values())
+    report['duration_ms'] = round((time.perf_counter() - start) * 1000, 1)
+    return report
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Verify project setup")
+    parser.add_argument('--json', action='store_true', help="Run concurrent health checks and print a JSON report")
+    parser.add_argument('--checks', help=f"Comma-separated subset of: {', '.join(PROBES)}")
+    parser.add_argument('--timeout', type=float, default=DEFAULT_PROBE_TIMEOUT, help="Per-probe timeout in seconds")
+    args = parser.parse_args()
+    if args.checks:
+        args.checks = [name.strip() for name in args.checks.split(',') if name.strip()]
+        unknown = [name for name in args.checks if name not in PROBES]
+        if unknown:
+            parser.error(f"Unknown checks: {', '.join(unknown)}")
+    return args
+
 if __name__ == "__main__":
+    args = parse_args()
+    if args.json:
+        report = run_health_checks(args.checks, args.timeout)
+        print(json.dumps(report, indent=2))
+        # Exit without waiting on any probe thread that is still hung
+        sys.stdout.flush()
+        os._exit(0 if report['ok'] else 1)
     main()
 